@@ -10,12 +10,18 @@ import uuid
 import time as sync_time
 import random
 import functools
+import math
+import zlib
+import io
+import threading
+import tracemalloc
+from collections import deque, Counter
 from decimal import Decimal, getcontext
 from datetime import time, datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import ccxt.async_support as ccxt
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -126,6 +132,17 @@ def init_database():
                     is_locked BOOLEAN NOT NULL DEFAULT FALSE,
                     locked_at TIMESTAMP WITH TIME ZONE
                 );
+                CREATE TABLE IF NOT EXISTS portfolio_ledger (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    exchange TEXT NOT NULL,
+                    event_type TEXT NOT NULL CHECK (event_type IN ('buy', 'sell', 'adjust')),
+                    quantity TEXT,
+                    price TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS portfolio_ledger_position_idx ON portfolio_ledger (user_id, symbol, exchange, id);
             ''')
             conn.commit()
 
@@ -141,6 +158,15 @@ def init_database():
 
             add_column_if_not_exists('portfolio', 'alert_last_price', 'TEXT')
             add_column_if_not_exists('bot_lock', 'owner_id', 'TEXT')
+            add_column_if_not_exists('portfolio', 'realized_pnl', "TEXT NOT NULL DEFAULT '0'")
+
+            # --- Ledger Seeding (opening event for positions created before the ledger) ---
+            cur.execute("""
+                INSERT INTO portfolio_ledger (user_id, symbol, exchange, event_type, quantity, price)
+                SELECT p.user_id, p.symbol, p.exchange, 'adjust', p.quantity, p.avg_price FROM portfolio p
+                WHERE NOT EXISTS (SELECT 1 FROM portfolio_ledger l WHERE l.user_id = p.user_id AND l.symbol = p.symbol AND l.exchange = p.exchange)
+            """)
+            if cur.rowcount: logger.info(f"تمت إضافة {cur.rowcount} حدث افتتاحي إلى سجل المعاملات.")
             
             # --- Data Initialization ---
             cur.execute("INSERT INTO bot_lock (id, is_locked) VALUES (%s, FALSE) ON CONFLICT (id) DO NOTHING", (LOCK_ID,))
@@ -165,6 +191,8 @@ def init_database():
 
 
 exchanges = {}
+_thread_state = threading.local()
+background_worker = None
 
 MAIN_KEYBOARD = [
     [KeyboardButton("📊 عرض المحفظة")],
@@ -175,24 +203,45 @@ MAIN_KEYBOARD = [
 MAIN_REPLY_MARKUP = ReplyKeyboardMarkup(MAIN_KEYBOARD, resize_keyboard=True)
 
 # --- Post-Init & Shutdown ---
-async def post_init(application: Application):
-    global exchanges
+def create_exchange_clients():
+    clients = {}
     exchange_ids = ['binance', 'okx', 'kucoin', 'gateio', 'bybit', 'mexc']
     for ex_id in exchange_ids:
         try:
             exchange_class = getattr(ccxt, ex_id)
-            exchanges[ex_id] = exchange_class({'enableRateLimit': True, 'options': {'defaultType': 'spot'}})
+            clients[ex_id] = exchange_class({'enableRateLimit': True, 'options': {'defaultType': 'spot'}})
             logger.info(f"تم الاتصال بمنصة {ex_id} بنجاح.")
         except Exception as e:
             logger.error(f"فشل الاتصال بمنصة {ex_id}: {e}")
-            
-    cairo_tz = ZoneInfo("Africa/Cairo")
-    report_time = time(hour=23, minute=55, tzinfo=cairo_tz) 
-    
-    if application.job_queue:
-        application.job_queue.run_daily(send_daily_report, time=report_time, name="daily_report")
-        application.job_queue.run_repeating(check_alerts, interval=timedelta(minutes=5), name="price_alerts")
-        logger.info(f"تم جدولة المهام الدورية بنجاح.")
+    return clients
+
+async def close_exchange_clients(clients):
+    for ex_id, ex_instance in clients.items():
+        try:
+            await ex_instance.close()
+            logger.info(f"تم إغلاق الاتصال بمنصة {ex_id}.")
+        except: pass
+
+def active_exchanges():
+    """Exchange clients bound to the calling thread's event loop."""
+    return getattr(_thread_state, 'exchanges', exchanges)
+
+async def post_init(application: Application):
+    global background_worker
+    exchanges.update(create_exchange_clients())
+    MAIN_LOOP_LAG.start()
+
+    main_loop = asyncio.get_running_loop()
+    def notify_admin_from_worker(text):
+        asyncio.run_coroutine_threadsafe(notify_admin(application.bot, text), main_loop)
+    background_worker = BackgroundWorker(notify_admin_from_worker)
+    background_worker.start()
+    logger.info(f"تم تشغيل عامل المهام الدورية في خيط منفصل.")
+
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("lag", lag_command))
+    application.add_handler(CommandHandler("sell", sell_command))
+    application.add_handler(CommandHandler("rebuild", rebuild_positions_command))
 
     if ADMIN_CHAT_ID:
         try:
@@ -202,12 +251,11 @@ async def post_init(application: Application):
             logger.error(f"فشل إرسال رسالة بدء التشغيل للمدير: {e}")
 
 async def post_shutdown(application: Application, instance_id: str):
+    if background_worker:
+        await asyncio.to_thread(background_worker.stop)
+    MAIN_LOOP_LAG.stop()
     release_lock(instance_id)
-    for ex_id, ex_instance in exchanges.items():
-        try:
-            await ex_instance.close()
-            logger.info(f"تم إغلاق الاتصال بمنصة {ex_id}.")
-        except: pass
+    await close_exchange_clients(exchanges)
 
 # --- Helper Functions ---
 def format_price(price_decimal):
@@ -220,34 +268,128 @@ def format_price(price_decimal):
 def format_quantity(quantity_decimal): return f"{Decimal(quantity_decimal).normalize()}"
 
 # --- Database Functions ---
+# Positions in `portfolio` are materialized from the append-only `portfolio_ledger`:
+# every event is appended and folded into its position row in the same transaction.
+# An `adjust` to quantity 0 is the close event written when a coin is removed: it
+# resets the position entirely, realized PnL included, so a later buy starts fresh.
+EMPTY_POSITION = (Decimal('0'), Decimal('0'), Decimal('0'))
+
+def apply_ledger_event(position, event_type, quantity=None, price=None):
+    """Fold one ledger event into a (quantity, avg_price, realized_pnl) position."""
+    held, avg_price, realized_pnl = position
+    if event_type == 'buy':
+        total_quantity = held + quantity
+        avg_price = ((held * avg_price) + (quantity * price)) / total_quantity
+        held = total_quantity
+    elif event_type == 'sell':
+        if quantity > held: raise ValueError("sell quantity exceeds position")
+        realized_pnl += (price - avg_price) * quantity
+        held -= quantity
+    elif event_type == 'adjust':
+        if quantity == 0: return EMPTY_POSITION
+        if quantity is not None: held = quantity
+        if price is not None: avg_price = price
+    else:
+        raise ValueError(f"unknown ledger event: {event_type}")
+    return held, avg_price, realized_pnl
+
+def lock_user_ledger(cur, user_id):
+    """Serialize ledger writers and rebuilds for one user until the transaction ends."""
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (user_id,))
+
+def record_ledger_event(cur, user_id, symbol, exchange, event_type, quantity=None, price=None):
+    lock_user_ledger(cur, user_id)
+    cur.execute("SELECT quantity, avg_price, realized_pnl FROM portfolio WHERE user_id = %s AND symbol = %s AND exchange = %s FOR UPDATE", (user_id, symbol, exchange))
+    row = cur.fetchone()
+    position = tuple(Decimal(v) for v in row) if row else EMPTY_POSITION
+    held, avg_price, realized_pnl = apply_ledger_event(position, event_type, quantity, price)
+    cur.execute("INSERT INTO portfolio_ledger (user_id, symbol, exchange, event_type, quantity, price) VALUES (%s, %s, %s, %s, %s, %s)",
+                (user_id, symbol, exchange, event_type, None if quantity is None else str(quantity), None if price is None else str(price)))
+    if row:
+        cur.execute("UPDATE portfolio SET quantity = %s, avg_price = %s, realized_pnl = %s WHERE user_id = %s AND symbol = %s AND exchange = %s",
+                    (str(held), str(avg_price), str(realized_pnl), user_id, symbol, exchange))
+    else:
+        cur.execute("INSERT INTO portfolio (user_id, symbol, exchange, quantity, avg_price, realized_pnl) VALUES (%s, %s, %s, %s, %s, %s)",
+                    (user_id, symbol, exchange, str(held), str(avg_price), str(realized_pnl)))
+    return held, avg_price, realized_pnl
+
+def db_get_position_key(cur, coin_id, user_id):
+    cur.execute("SELECT symbol, exchange FROM portfolio WHERE id = %s AND user_id = %s", (coin_id, user_id))
+    return cur.fetchone()
+
 def db_add_or_update_coin(user_id, symbol, exchange, quantity, price):
     conn = get_db_connection()
     if not conn: return
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT quantity, avg_price FROM portfolio WHERE user_id = %s AND symbol = %s AND exchange = %s",(user_id, symbol, exchange))
-            result = cur.fetchone()
-            quantity_dec = Decimal(str(quantity)); price_dec = Decimal(str(price))
-            if result:
-                old_quantity = Decimal(result[0]); old_avg_price = Decimal(result[1])
-                total_quantity = old_quantity + quantity_dec
-                new_avg_price = ((old_quantity * old_avg_price) + (quantity_dec * price_dec)) / total_quantity
-                cur.execute("UPDATE portfolio SET quantity = %s, avg_price = %s WHERE user_id = %s AND symbol = %s AND exchange = %s",(str(total_quantity), str(new_avg_price), user_id, symbol, exchange))
-            else:
-                cur.execute("INSERT INTO portfolio (user_id, symbol, exchange, quantity, avg_price) VALUES (%s, %s, %s, %s, %s)",(user_id, symbol.upper(), exchange.lower(), str(quantity_dec), str(price_dec)))
+            record_ledger_event(cur, user_id, symbol.upper(), exchange.lower(), 'buy', Decimal(str(quantity)), Decimal(str(price)))
         conn.commit()
     finally: conn.close()
 
+def db_record_sell(coin_id, user_id, quantity, price):
+    """Returns the realized PnL of this sale, or None if the coin was not found.
+    Raises ValueError when selling more than the position holds."""
+    conn = get_db_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            lock_user_ledger(cur, user_id)
+            cur.execute("SELECT symbol, exchange, avg_price FROM portfolio WHERE id = %s AND user_id = %s FOR UPDATE", (coin_id, user_id))
+            row = cur.fetchone()
+            if not row: return None
+            symbol, exchange, avg_price = row[0], row[1], Decimal(row[2])
+            quantity = Decimal(quantity); price = Decimal(price)
+            held, _, _ = record_ledger_event(cur, user_id, symbol, exchange, 'sell', quantity, price)
+            if held == 0:
+                # Fully exited: disarm the coin alert so the ticker is no longer polled.
+                cur.execute("UPDATE portfolio SET alert_threshold = NULL, alert_last_price = NULL WHERE id = %s", (coin_id,))
+        conn.commit()
+        return (price - avg_price) * quantity
+    except ValueError:
+        conn.rollback()
+        raise
+    finally: conn.close()
+
+def db_rebuild_positions(user_id):
+    """Replay the ledger and rewrite the user's materialized positions. Returns the number of positions written."""
+    conn = get_db_connection()
+    if not conn: return 0
+    written = 0
+    try:
+        with conn.cursor() as cur:
+            # Lock before reading the ledger so no event can commit between the replay and the writes.
+            lock_user_ledger(cur, user_id)
+            cur.execute("SELECT symbol, exchange, event_type, quantity, price FROM portfolio_ledger WHERE user_id = %s ORDER BY id", (user_id,))
+            positions = {}
+            for symbol, exchange, event_type, quantity, price in cur.fetchall():
+                positions[(symbol, exchange)] = apply_ledger_event(
+                    positions.get((symbol, exchange), EMPTY_POSITION), event_type,
+                    None if quantity is None else Decimal(quantity), None if price is None else Decimal(price))
+            cur.execute("SELECT symbol, exchange FROM portfolio WHERE user_id = %s FOR UPDATE", (user_id,))
+            existing = set(cur.fetchall())
+            for (symbol, exchange), (held, avg_price, realized_pnl) in positions.items():
+                if (symbol, exchange) in existing:
+                    cur.execute("UPDATE portfolio SET quantity = %s, avg_price = %s, realized_pnl = %s WHERE user_id = %s AND symbol = %s AND exchange = %s",
+                                (str(held), str(avg_price), str(realized_pnl), user_id, symbol, exchange))
+                    written += 1
+                elif held > 0:
+                    cur.execute("INSERT INTO portfolio (user_id, symbol, exchange, quantity, avg_price, realized_pnl) VALUES (%s, %s, %s, %s, %s, %s)",
+                                (user_id, symbol, exchange, str(held), str(avg_price), str(realized_pnl)))
+                    written += 1
+        conn.commit()
+        return written
+    finally: conn.close()
+
 def db_get_portfolio(user_id):
     conn = get_db_connection();
     if not conn: return []
     portfolio = []
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT id, symbol, exchange, quantity, avg_price, alert_threshold FROM portfolio WHERE user_id = %s ORDER BY symbol", (user_id,))
+            cur.execute("SELECT id, symbol, exchange, quantity, avg_price, alert_threshold, realized_pnl FROM portfolio WHERE user_id = %s ORDER BY symbol", (user_id,))
             rows = cur.fetchall()
             for row in rows:
-                portfolio.append({'id': row[0], 'symbol': row[1], 'exchange': row[2], 'quantity': row[3], 'avg_price': row[4], 'alert_threshold': row[5]})
+                portfolio.append({'id': row[0], 'symbol': row[1], 'exchange': row[2], 'quantity': row[3], 'avg_price': row[4], 'alert_threshold': row[5], 'realized_pnl': row[6]})
     finally: conn.close()
     return portfolio
 
@@ -265,21 +407,19 @@ def db_get_coin_by_id(coin_id, user_id):
         if conn: conn.close()
 
 def db_update_coin_details(coin_id, user_id, new_quantity=None, new_avg_price=None):
+    if new_quantity is None and new_avg_price is None: return False
     conn = get_db_connection()
     if not conn: return False
     try:
         with conn.cursor() as cur:
+            key = db_get_position_key(cur, coin_id, user_id)
+            if not key: return False
             if new_quantity is not None:
-                cur.execute("UPDATE portfolio SET quantity = %s WHERE id = %s AND user_id = %s",
-                            (str(Decimal(new_quantity)), coin_id, user_id))
-            elif new_avg_price is not None:
-                cur.execute("UPDATE portfolio SET avg_price = %s WHERE id = %s AND user_id = %s",
-                            (str(Decimal(new_avg_price)), coin_id, user_id))
+                record_ledger_event(cur, user_id, key[0], key[1], 'adjust', quantity=Decimal(new_quantity))
             else:
-                return False
-            updated_rows = cur.rowcount
+                record_ledger_event(cur, user_id, key[0], key[1], 'adjust', price=Decimal(new_avg_price))
         conn.commit()
-        return updated_rows > 0
+        return True
     finally:
         if conn: conn.close()
 
@@ -289,8 +429,11 @@ def db_remove_coin(coin_id, user_id):
     rows_deleted = 0
     try:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM portfolio WHERE id = %s AND user_id = %s", (coin_id, user_id))
-            rows_deleted = cur.rowcount
+            key = db_get_position_key(cur, coin_id, user_id)
+            if key:
+                record_ledger_event(cur, user_id, key[0], key[1], 'adjust', quantity=Decimal('0'))
+                cur.execute("DELETE FROM portfolio WHERE id = %s AND user_id = %s", (coin_id, user_id))
+                rows_deleted = cur.rowcount
         conn.commit()
     finally: conn.close()
     return rows_deleted > 0
@@ -388,7 +531,8 @@ async def received_global_threshold(update: Update, context: ContextTypes.DEFAUL
         return SET_GLOBAL_ALERT
 async def custom_alerts_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    portfolio = db_get_portfolio(user_id)
+    # Closed (fully sold) positions cannot be alerted on; their alert was disarmed on exit.
+    portfolio = [coin for coin in db_get_portfolio(user_id) if Decimal(coin['quantity']) > 0]
     if not portfolio:
         await update.message.reply_text("محفظتك فارغة. أضف عملات أولاً.", reply_markup=MAIN_REPLY_MARKUP)
         return ConversationHandler.END
@@ -440,7 +584,7 @@ async def received_coin_threshold(update: Update, context: ContextTypes.DEFAULT_
 
 # --- Portfolio Logic ---
 async def fetch_price(exchange_id, symbol):
-    exchange = exchanges.get(exchange_id)
+    exchange = active_exchanges().get(exchange_id)
     if not exchange: 
         logger.error(f"Exchange {exchange_id} not initialized.")
         return None
@@ -471,7 +615,7 @@ async def fetch_price(exchange_id, symbol):
     return None
 
 async def get_portfolio_value(user_id: int):
-    portfolio = db_get_portfolio(user_id)
+    portfolio = [item for item in db_get_portfolio(user_id) if Decimal(item['quantity']) > 0]
     if not portfolio: return Decimal('0.0')
     tasks = [fetch_price(item['exchange'], item['symbol']) for item in portfolio]
     results = await asyncio.gather(*tasks)
@@ -482,11 +626,15 @@ async def get_portfolio_value(user_id: int):
         else: total_value += quantity * Decimal(item['avg_price'])
     return total_value
 async def generate_portfolio_report(user_id: int) -> str:
-    portfolio = db_get_portfolio(user_id)
-    if not portfolio: return "محفظتك فارغة حالياً."
+    all_positions = db_get_portfolio(user_id)
+    if not all_positions: return "محفظتك فارغة حالياً."
+    # Fully sold positions are kept for their realized PnL but are not priced or listed as holdings.
+    portfolio = [item for item in all_positions if Decimal(item['quantity']) > 0]
+    closed_positions = [item for item in all_positions if Decimal(item['quantity']) == 0]
     tasks = [fetch_price(item['exchange'], item['symbol']) for item in portfolio]
     results = await asyncio.gather(*tasks)
     total_portfolio_value = Decimal('0.0'); total_investment_cost = Decimal('0.0')
+    total_realized_pnl = sum((Decimal(item['realized_pnl']) for item in all_positions), Decimal('0.0'))
     report_lines = []
     
     for i, item in enumerate(portfolio):
@@ -506,8 +654,9 @@ async def generate_portfolio_report(user_id: int) -> str:
     summary = (f"**📊 ملخص المحفظة**\n\n"
                f"▪️ **رأس المال:** `{format_price(total_investment_cost)}`\n"
                f"▪️ **القيمة الحالية:** `{format_price(total_portfolio_value)}`\n"
-               f"{total_pnl_icon} **إجمالي الربح/الخسارة:**\n"
-               f"`{format_price(total_pnl)} ({total_pnl_percent:+.2f}%)`\n\n"
+               f"{total_pnl_icon} **الربح/الخسارة غير المحقق:**\n"
+               f"`{format_price(total_pnl)} ({total_pnl_percent:+.2f}%)`\n"
+               f"💵 **الربح/الخسارة المحقق:** `{format_price(total_realized_pnl)}`\n\n"
                f"--- **التفاصيل** ---\n")
     report_lines.append(summary)
     
@@ -536,6 +685,13 @@ async def generate_portfolio_report(user_id: int) -> str:
         
         report_lines.append(line)
         report_lines.append("---")
+
+    for item in closed_positions:
+        realized_pnl = Decimal(item['realized_pnl'])
+        pnl_icon = "📈" if realized_pnl >= 0 else "📉"
+        report_lines.append(f"🔒 *مغلق* 🆔 `{item['id']}` | **{item['symbol']}** | `{item['exchange'].capitalize()}`\n"
+                            f"{pnl_icon} الربح/الخسارة المحقق: `{format_price(realized_pnl)}`")
+        report_lines.append("---")
         
     return "\n".join(report_lines)
 async def portfolio_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -547,7 +703,7 @@ async def portfolio_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except TelegramError as e:
         logger.error(f"خطأ في عرض المحفظة: {e}")
         await update.message.reply_text("حدث خطأ أثناء عرض المحفظة. الرجاء المحاولة مرة أخرى.")
-async def send_daily_report(context: ContextTypes.DEFAULT_TYPE) -> None:
+async def send_daily_report(bot: Bot) -> None:
     conn = get_db_connection();
     if not conn: return
     try:
@@ -556,67 +712,591 @@ async def send_daily_report(context: ContextTypes.DEFAULT_TYPE) -> None:
             user_ids = [row[0] for row in cur.fetchall()]
     finally: conn.close()
     for user_id in user_ids:
+        await yield_to_interactive()
         try:
             report_text = await generate_portfolio_report(user_id)
             final_report = f"**🗓️ تقريرك اليومي للمحفظة**\n\n{report_text}"
-            await context.bot.send_message(chat_id=user_id, text=final_report, parse_mode=ParseMode.MARKDOWN)
+            await bot.send_message(chat_id=user_id, text=final_report, parse_mode=ParseMode.MARKDOWN)
             await asyncio.sleep(1)
         except Exception as e:
             logger.error(f"فشل إرسال التقرير اليومي للمستخدم {user_id}: {e}")
-async def check_alerts(context: ContextTypes.DEFAULT_TYPE) -> None:
-    conn = get_db_connection();
-    if not conn: return
+    budget_report = polling_budget_report()
+    logger.info(budget_report.replace('*', '').replace('`', ''))
+    if ADMIN_CHAT_ID:
+        try:
+            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=budget_report, parse_mode=ParseMode.MARKDOWN)
+        except Exception as e:
+            logger.error(f"فشل إرسال تقرير ميزانية الطلبات للمدير: {e}")
+    reset_polling_stats()
+# --- Alert Scheduler (Hashed Time Wheel) ---
+ALERT_CHECK_INTERVAL = timedelta(minutes=5)
+ALERT_WHEEL_SLOTS = 60
+ALERT_WHEEL_TICK = ALERT_CHECK_INTERVAL / ALERT_WHEEL_SLOTS
+PORTFOLIO_ALERT_GATE = timedelta(hours=23, minutes=55)
+
+class TimeWheel:
+    """Hashed timing wheel. Every key has a home slot derived from its hash, so
+    entries are spread evenly over one revolution instead of firing together."""
+
+    def __init__(self, slots):
+        self._slots = [{} for _ in range(slots)]
+        self._where = {}
+        self.cursor = 0
+
+    def __len__(self): return len(self._where)
+    def __contains__(self, key): return key in self._where
+    def keys(self): return list(self._where)
+
+    def home_slot(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self._slots)
+
+    def schedule(self, key, payload, delay):
+        """Fire `key` on the `delay`-th next tick (delay >= 1)."""
+        self.discard(key)
+        delay = max(1, int(delay))
+        slot = (self.cursor + delay - 1) % len(self._slots)
+        self._slots[slot][key] = [(delay - 1) // len(self._slots), payload]
+        self._where[key] = slot
+
+    def schedule_home(self, key, payload, min_delay=1):
+        """Fire `key` when the wheel next reaches its home slot, at least `min_delay` ticks from now."""
+        slots = len(self._slots)
+        delay = (self.home_slot(key) - self.cursor) % slots + 1
+        if delay < min_delay:
+            delay += -(-(min_delay - delay) // slots) * slots
+        self.schedule(key, payload, delay)
+
+    def payload(self, key):
+        return self._slots[self._where[key]][key][1]
+
+    def update(self, key, payload):
+        self._slots[self._where[key]][key][1] = payload
+
+    def discard(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None: self._slots[slot].pop(key, None)
+
+    def tick(self):
+        """Advance one slot and return the (key, payload) pairs that are due."""
+        bucket = self._slots[self.cursor]
+        due = []
+        for key, entry in list(bucket.items()):
+            if entry[0] > 0:
+                entry[0] -= 1
+                continue
+            del bucket[key]; del self._where[key]
+            due.append((key, entry[1]))
+        self.cursor = (self.cursor + 1) % len(self._slots)
+        return due
+
+ALERT_WHEEL = TimeWheel(ALERT_WHEEL_SLOTS)
+
+def ticks_until(moment):
+    seconds = (moment - datetime.now(ZoneInfo("UTC"))).total_seconds()
+    return max(1, math.ceil(seconds / ALERT_WHEEL_TICK.total_seconds()))
+
+def db_get_users_for_alert_check():
+    conn = get_db_connection()
+    if not conn: return []
+    users = []
     try:
         with conn.cursor() as cur:
             cur.execute("SELECT user_id, global_alert_threshold, last_portfolio_value, last_check_time FROM user_settings WHERE alerts_enabled = TRUE")
-            users_to_check = cur.fetchall()
+            for row in cur.fetchall():
+                users.append({'user_id': row[0], 'threshold': row[1], 'last_portfolio_value': row[2], 'last_check_time': row[3]})
     finally: conn.close()
-    for user_id, threshold, last_value_str, last_check_time in users_to_check:
-        try:
-            if last_value_str is None or last_check_time is None:
-                current_value = await get_portfolio_value(user_id); db_update_last_portfolio_value(user_id, current_value); continue
-            if last_check_time and (datetime.now(ZoneInfo("UTC")) - last_check_time < timedelta(hours=23, minutes=55)): continue
-            last_value = Decimal(last_value_str); current_value = await get_portfolio_value(user_id)
-            if last_value == 0: continue
-            percentage_change = abs((current_value - last_value) / last_value * 100)
-            if percentage_change >= Decimal(threshold):
-                direction_text = "ارتفاع" if current_value > last_value else "انخفاض"
-                direction_icon = "📈" if current_value > last_value else "📉"
-                alert_message = (f"**🚨 تنبيه حركة المحفظة!** {direction_icon}\n\n"
-                                 f"حدث **{direction_text}** في القيمة الإجمالية لمحفظتك بنسبة **{percentage_change:.2f}%**.\n\n"
-                                 f"▪️ القيمة السابقة: `{format_price(last_value)}`\n"
-                                 f"▪️ القيمة الحالية: `{format_price(current_value)}`")
-                await context.bot.send_message(chat_id=user_id, text=alert_message, parse_mode=ParseMode.MARKDOWN)
-                db_update_last_portfolio_value(user_id, current_value)
-            await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"فشل فحص تنبيه المحفظة للمستخدم {user_id}: {e}")
+    return users
 
-    coins_to_check = db_get_coins_for_alert_check()
-    for coin in coins_to_check:
+def sync_alert_wheel():
+    """Reconcile the wheel with the database once per revolution: new alerts get a
+    home slot, existing ones keep their position, disabled ones are dropped.
+    Coin alerts are grouped per (exchange, symbol) so each ticker is fetched once."""
+    wanted = {}
+    for user in db_get_users_for_alert_check():
+        wanted[f"user:{user['user_id']}"] = user
+    coins = db_get_coins_for_alert_check()
+    for coin in coins:
+        wanted.setdefault(f"ticker:{coin['exchange']}:{coin['symbol']}", []).append(coin)
+    polling_stats['fixed_polls'] += len(coins)
+    for key in ALERT_WHEEL.keys():
+        if key not in wanted: ALERT_WHEEL.discard(key)
+    for key, payload in wanted.items():
+        if key not in ALERT_WHEEL: ALERT_WHEEL.schedule_home(key, payload)
+        elif key.startswith('ticker:') and ALERT_POLLING_MODE == 'adaptive' and alert_signature(ALERT_WHEEL.payload(key)) != alert_signature(payload):
+            # The parked delay was derived from the old triggers; re-derive it for the new ones.
+            reschedule_ticker(key, payload)
+        else: ALERT_WHEEL.update(key, payload)
+    logger.info(f"تمت مزامنة عجلة التنبيهات: {len(ALERT_WHEEL)} عنصر.")
+
+# --- Adaptive Coin Polling ---
+# 'fixed' polls every ticker once per ALERT_CHECK_INTERVAL; 'adaptive' polls a ticker
+# more often the closer its price is to an armed threshold relative to its volatility.
+ALERT_POLLING_MODE = os.getenv('ALERT_POLLING_MODE', 'fixed').lower()
+ADAPTIVE_MIN_INTERVAL = timedelta(seconds=30)
+ADAPTIVE_MAX_INTERVAL = timedelta(minutes=30)
+ADAPTIVE_SAFETY_FACTOR = 0.25
+ADAPTIVE_MIN_SAMPLES = 5
+PRICE_HISTORY_SIZE = 30
+
+price_history = {}
+polling_stats = {'polls': 0, 'fixed_polls': 0, 'since': datetime.now(ZoneInfo("UTC"))}
+
+def record_price(exchange_id, symbol, price):
+    history = price_history.setdefault((exchange_id, symbol), deque(maxlen=PRICE_HISTORY_SIZE))
+    history.append((sync_time.monotonic(), float(price)))
+
+def realized_variance(exchange_id, symbol):
+    """Variance of log returns per second over the recent samples, or None if too few."""
+    history = price_history.get((exchange_id, symbol))
+    if not history or len(history) < ADAPTIVE_MIN_SAMPLES: return None
+    samples = list(history)
+    squared_returns, elapsed = 0.0, 0.0
+    for (t0, p0), (t1, p1) in zip(samples, samples[1:]):
+        if p0 <= 0 or p1 <= 0 or t1 <= t0: continue
+        squared_returns += math.log(p1 / p0) ** 2
+        elapsed += t1 - t0
+    return squared_returns / elapsed if elapsed > 0 else None
+
+def trigger_distance(alerts, current_price):
+    """Smallest log-distance from the current price to any armed alert's trigger price."""
+    price = float(current_price)
+    nearest = None
+    for coin in alerts:
+        last = float(coin['alert_last_price']) if coin['alert_last_price'] else price
+        threshold = float(coin['alert_threshold']) / 100
+        if last <= 0 or price <= 0: continue
+        upper = last * (1 + threshold)
+        lower = last * (1 - threshold)
+        distance = math.log(upper / price)
+        if lower > 0: distance = min(distance, math.log(price / lower))
+        distance = max(distance, 0.0)
+        nearest = distance if nearest is None else min(nearest, distance)
+    return nearest
+
+def next_poll_delay(alerts, current_price):
+    """Poll after a fraction of the expected first-passage time d^2 / sigma^2,
+    clamped to [ADAPTIVE_MIN_INTERVAL, ADAPTIVE_MAX_INTERVAL]."""
+    exchange_id, symbol = alerts[0]['exchange'], alerts[0]['symbol']
+    variance = realized_variance(exchange_id, symbol)
+    distance = trigger_distance(alerts, current_price)
+    if variance is None or distance is None: return ALERT_CHECK_INTERVAL
+    if variance == 0: return ADAPTIVE_MAX_INTERVAL
+    seconds = ADAPTIVE_SAFETY_FACTOR * distance ** 2 / variance
+    return min(max(timedelta(seconds=seconds), ADAPTIVE_MIN_INTERVAL), ADAPTIVE_MAX_INTERVAL)
+
+def alert_signature(alerts):
+    return sorted((coin['id'], coin['alert_threshold'], coin['alert_last_price']) for coin in alerts)
+
+def reschedule_ticker(key, alerts):
+    """Re-derive an adaptive ticker's next poll from its last recorded price."""
+    history = price_history.get((alerts[0]['exchange'], alerts[0]['symbol']))
+    if not history:
+        ALERT_WHEEL.schedule_home(key, alerts)
+        return
+    sampled_at, last_price = history[-1]
+    delay = next_poll_delay(alerts, last_price) - timedelta(seconds=sync_time.monotonic() - sampled_at)
+    ALERT_WHEEL.schedule(key, alerts, math.ceil(max(delay, timedelta(0)) / ALERT_WHEEL_TICK))
+
+def polling_budget_report():
+    polls, fixed_polls = polling_stats['polls'], polling_stats['fixed_polls']
+    saved = fixed_polls - polls
+    saved_percent = (saved / fixed_polls * 100) if fixed_polls > 0 else 0
+    since = polling_stats['since'].astimezone(ZoneInfo("Africa/Cairo")).strftime('%Y-%m-%d %H:%M')
+    return (f"**📡 ميزانية طلبات الأسعار**\n\n"
+            f"▪️ الوضع: `{ALERT_POLLING_MODE}`\n"
+            f"▪️ منذ: `{since}`\n"
+            f"▪️ الطلبات الفعلية: `{polls}`\n"
+            f"▪️ طلبات الجدول الثابت: `{fixed_polls}`\n"
+            f"▪️ التوفير: `{saved} ({saved_percent:+.2f}%)`")
+
+def reset_polling_stats():
+    polling_stats.update(polls=0, fixed_polls=0, since=datetime.now(ZoneInfo("UTC")))
+
+async def check_portfolio_alert(bot, user):
+    """Evaluate one user's portfolio alert and return the next time it is due."""
+    user_id = user['user_id']
+    last_value_str, last_check_time = user['last_portfolio_value'], user['last_check_time']
+    now = datetime.now(ZoneInfo("UTC"))
+    if last_value_str is None or last_check_time is None:
+        current_value = await get_portfolio_value(user_id); db_update_last_portfolio_value(user_id, current_value)
+        return now + PORTFOLIO_ALERT_GATE
+    if now - last_check_time < PORTFOLIO_ALERT_GATE: return last_check_time + PORTFOLIO_ALERT_GATE
+    last_value = Decimal(last_value_str); current_value = await get_portfolio_value(user_id)
+    if last_value == 0: return now
+    percentage_change = abs((current_value - last_value) / last_value * 100)
+    if percentage_change >= Decimal(user['threshold']):
+        direction_text = "ارتفاع" if current_value > last_value else "انخفاض"
+        direction_icon = "📈" if current_value > last_value else "📉"
+        alert_message = (f"**🚨 تنبيه حركة المحفظة!** {direction_icon}\n\n"
+                         f"حدث **{direction_text}** في القيمة الإجمالية لمحفظتك بنسبة **{percentage_change:.2f}%**.\n\n"
+                         f"▪️ القيمة السابقة: `{format_price(last_value)}`\n"
+                         f"▪️ القيمة الحالية: `{format_price(current_value)}`")
+        await bot.send_message(chat_id=user_id, text=alert_message, parse_mode=ParseMode.MARKDOWN)
+        db_update_last_portfolio_value(user_id, current_value)
+        return now + PORTFOLIO_ALERT_GATE
+    return now
+
+async def check_coin_alert(bot, coin, current_price):
+    last_price = Decimal(coin['alert_last_price']) if coin['alert_last_price'] else current_price
+    threshold = Decimal(coin['alert_threshold'])
+
+    if last_price == 0: return
+
+    percentage_change = abs((current_price - last_price) / last_price * 100)
+    if percentage_change >= threshold:
+        direction_text = "ارتفاع" if current_price > last_price else "انخفاض"
+        direction_icon = "📈" if current_price > last_price else "📉"
+        alert_message = (f"**🔔 تنبيه سعر {coin['symbol']}!** {direction_icon}\n\n"
+                         f"حدث **{direction_text}** في السعر بنسبة **{percentage_change:.2f}%**.\n\n"
+                         f"▪️ السعر السابق: `{format_price(last_price)}`\n"
+                         f"▪️ السعر الحالي: `{format_price(current_price)}`")
+        await bot.send_message(chat_id=coin['user_id'], text=alert_message, parse_mode=ParseMode.MARKDOWN)
+        db_set_coin_alert(coin['id'], threshold, current_price)
+        coin['alert_last_price'] = str(current_price)
+
+async def poll_ticker(bot, alerts):
+    """Fetch one ticker and evaluate every alert armed on it. Returns the price or None."""
+    exchange_id, symbol = alerts[0]['exchange'], alerts[0]['symbol']
+    polling_stats['polls'] += 1
+    current_price_val = await fetch_price(exchange_id, symbol)
+    if not current_price_val: return None
+    record_price(exchange_id, symbol, current_price_val)
+    current_price = Decimal(str(current_price_val))
+    for coin in alerts:
         try:
-            current_price_val = await fetch_price(coin['exchange'], coin['symbol'])
-            if not current_price_val: continue
-            
-            current_price = Decimal(str(current_price_val))
-            last_price = Decimal(coin['alert_last_price']) if coin['alert_last_price'] else current_price
-            threshold = Decimal(coin['alert_threshold'])
-            
-            if last_price == 0: continue
-
-            percentage_change = abs((current_price - last_price) / last_price * 100)
-            if percentage_change >= threshold:
-                direction_text = "ارتفاع" if current_price > last_price else "انخفاض"
-                direction_icon = "📈" if current_price > last_price else "📉"
-                alert_message = (f"**🔔 تنبيه سعر {coin['symbol']}!** {direction_icon}\n\n"
-                                 f"حدث **{direction_text}** في السعر بنسبة **{percentage_change:.2f}%**.\n\n"
-                                 f"▪️ السعر السابق: `{format_price(last_price)}`\n"
-                                 f"▪️ السعر الحالي: `{format_price(current_price)}`")
-                await context.bot.send_message(chat_id=coin['user_id'], text=alert_message, parse_mode=ParseMode.MARKDOWN)
-                db_set_coin_alert(coin['id'], threshold, current_price)
-            await asyncio.sleep(1)
+            await check_coin_alert(bot, coin, current_price)
         except Exception as e:
             logger.error(f"فشل فحص تنبيه العملة {coin['symbol']} for user {coin['user_id']}: {e}")
+    return current_price
+
+async def check_alerts(bot: Bot, ticks=1) -> None:
+    """Advance the wheel by `ticks` slots and evaluate only the alerts hashed into them,
+    so exchange requests are spread across ALERT_CHECK_INTERVAL. Callers that fell
+    behind pass the number of missed slots so a revolution keeps its wall-clock length."""
+    due = []
+    for _ in range(ticks):
+        if ALERT_WHEEL.cursor == 0:
+            sync_alert_wheel()
+        due.extend(ALERT_WHEEL.tick())
+    backoff_deadline = asyncio.get_running_loop().time() + INTERACTIVE_MAX_BACKOFF
+    for key, payload in due:
+        await yield_to_interactive(backoff_deadline)
+        if key.startswith('user:'):
+            try:
+                next_due = await check_portfolio_alert(bot, payload)
+            except Exception as e:
+                logger.error(f"فشل فحص تنبيه المحفظة للمستخدم {payload['user_id']}: {e}")
+                next_due = datetime.now(ZoneInfo("UTC"))
+            ALERT_WHEEL.schedule_home(key, payload, min_delay=ticks_until(next_due))
+        else:
+            current_price = None
+            try:
+                current_price = await poll_ticker(bot, payload)
+            except Exception as e:
+                logger.error(f"فشل فحص تنبيهات {key}: {e}")
+            if ALERT_POLLING_MODE == 'adaptive' and current_price:
+                delay = next_poll_delay(payload, current_price)
+                ALERT_WHEEL.schedule(key, payload, math.ceil(delay / ALERT_WHEEL_TICK))
+            else:
+                ALERT_WHEEL.schedule_home(key, payload)
+
+# --- Background Worker ---
+DAILY_REPORT_TIME = time(hour=23, minute=55, tzinfo=ZoneInfo("Africa/Cairo"))
+INTERACTIVE_LAG_BUDGET = 0.2
+INTERACTIVE_MAX_BACKOFF = 5.0
+WORKER_RESTART_BACKOFF_MIN = 5.0
+WORKER_RESTART_BACKOFF_MAX = 300.0
+WORKER_HEALTHY_RUNTIME = 600.0
+
+class LoopLagMonitor:
+    """Measures event-loop lag as how late a periodic sleep wakes up."""
+
+    def __init__(self, name, interval=0.5):
+        self.name = name
+        self.interval = interval
+        self.current = 0.0
+        self.average = 0.0
+        self.peak = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task: self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.current = lag
+            self.average = 0.9 * self.average + 0.1 * lag
+            self.peak = max(self.peak, lag)
+
+    def summary(self):
+        return (f"{self.name}: now={self.current * 1000:.0f}ms "
+                f"avg={self.average * 1000:.0f}ms peak={self.peak * 1000:.0f}ms")
+
+MAIN_LOOP_LAG = LoopLagMonitor("main")
+
+async def yield_to_interactive(deadline=None):
+    """Back off while the main loop is lagging so interactive updates keep priority.
+    Waits at most until `deadline` (loop time), or INTERACTIVE_MAX_BACKOFF from now."""
+    loop = asyncio.get_running_loop()
+    if deadline is None: deadline = loop.time() + INTERACTIVE_MAX_BACKOFF
+    while MAIN_LOOP_LAG.current > INTERACTIVE_LAG_BUDGET and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+
+def seconds_until_daily_report(now=None):
+    # Compare absolute timestamps: Cairo observes DST, so wall-clock differences are off
+    # by an hour on transition days and 23:55 can occur twice on the fall-back night.
+    now = now or datetime.now(DAILY_REPORT_TIME.tzinfo)
+    run_at = datetime.combine(now.date(), DAILY_REPORT_TIME)
+    if run_at.timestamp() <= now.timestamp(): run_at += timedelta(days=1)
+    return run_at.timestamp() - now.timestamp()
+
+async def notify_admin(bot, text):
+    if not ADMIN_CHAT_ID: return
+    try:
+        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=text)
+    except Exception as e:
+        logger.error(f"فشل إرسال إشعار للمدير: {e}")
+
+class BackgroundWorker(threading.Thread):
+    """Runs the periodic jobs (alert wheel, daily report) on a dedicated thread with its
+    own event loop, Bot and exchange clients. Their blocking DB calls and long reports
+    then never stall the interactive handlers on the main loop."""
+
+    def __init__(self, on_failure=None):
+        super().__init__(name="background-jobs", daemon=True)
+        self.loop = None
+        self.lag = LoopLagMonitor("background")
+        self._on_failure = on_failure
+        self._stopping = threading.Event()
+        self._stop_event = None
+
+    def run(self):
+        # _main is restarted with exponential backoff until stop() is called, so a
+        # transient failure (e.g. Bot.initialize during a network blip) is not fatal.
+        backoff = WORKER_RESTART_BACKOFF_MIN
+        while not self._stopping.is_set():
+            started = sync_time.monotonic()
+            try:
+                asyncio.run(self._main())
+                if self._stopping.is_set(): break
+                raise RuntimeError("background loop exited unexpectedly")
+            except Exception as e:
+                if sync_time.monotonic() - started > WORKER_HEALTHY_RUNTIME:
+                    backoff = WORKER_RESTART_BACKOFF_MIN
+                logger.error(f"توقف عامل المهام الدورية بسبب خطأ، إعادة التشغيل بعد {backoff:.0f} ثانية: {e}")
+                if self._on_failure:
+                    try:
+                        self._on_failure(f"⚠️ توقف عامل المهام الدورية: {e}\nإعادة التشغيل بعد {backoff:.0f} ثانية.")
+                    except Exception as notify_error:
+                        logger.error(f"فشل إرسال إشعار توقف العامل: {notify_error}")
+            self._stopping.wait(backoff)
+            backoff = min(backoff * 2, WORKER_RESTART_BACKOFF_MAX)
+
+    async def _main(self):
+        self._stop_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self._stopping.is_set(): return
+        _thread_state.exchanges = create_exchange_clients()
+        try:
+            async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+                self.lag.start()
+                jobs = [asyncio.create_task(self._run_alerts(bot)), asyncio.create_task(self._run_daily_report(bot))]
+                await self._stop_event.wait()
+                self.lag.stop()
+                for job in jobs: job.cancel()
+                await asyncio.gather(*jobs, return_exceptions=True)
+        finally:
+            await close_exchange_clients(_thread_state.exchanges)
+
+    def is_running(self):
+        return self.is_alive() and self.loop is not None and self.loop.is_running()
+
+    async def _run_alerts(self, bot):
+        tick = ALERT_WHEEL_TICK.total_seconds()
+        next_run = self.loop.time() + tick
+        while True:
+            await asyncio.sleep(max(0.0, next_run - self.loop.time()))
+            # Slots missed while a previous tick was slow are advanced together, so the
+            # wheel's revolution stays ALERT_CHECK_INTERVAL of wall-clock time.
+            ticks = 1 + int((self.loop.time() - next_run) // tick)
+            next_run += ticks * tick
+            try:
+                await check_alerts(bot, ticks)
+            except Exception as e:
+                logger.error(f"فشل تنفيذ دورة فحص التنبيهات: {e}")
+
+    async def _run_daily_report(self, bot):
+        while True:
+            await asyncio.sleep(seconds_until_daily_report())
+            try:
+                await send_daily_report(bot)
+            except Exception as e:
+                logger.error(f"فشل تنفيذ التقرير اليومي: {e}")
+
+    def run_coroutine(self, coro):
+        """Schedule `coro` on the worker loop from another thread; returns an awaitable."""
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def stop(self, timeout=30):
+        self._stopping.set()
+        loop, stop_event = self.loop, self._stop_event
+        if loop and stop_event:
+            try:
+                loop.call_soon_threadsafe(stop_event.set)
+            except RuntimeError:
+                pass  # loop already closed, e.g. while waiting to restart
+        self.join(timeout)
+        logger.info(f"تم إيقاف عامل المهام الدورية.")
+
+# --- Admin Diagnostics ---
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.01
+PROFILE_TOP_ENTRIES = 40
+profile_lock = asyncio.Lock()
+
+def is_admin(update: Update) -> bool:
+    return bool(ADMIN_CHAT_ID) and str(update.effective_chat.id) == str(ADMIN_CHAT_ID)
+
+def sample_stacks(seconds):
+    """Sample the stacks of all other threads every PROFILE_SAMPLE_INTERVAL seconds.
+    Returns a Counter of collapsed stacks (flamegraph format)."""
+    samples = Counter()
+    own_id = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    deadline = sync_time.monotonic() + seconds
+    while sync_time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id: continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            samples[';'.join(reversed(stack))] += 1
+        sync_time.sleep(PROFILE_SAMPLE_INTERVAL)
+    return samples
+
+def top_allocations(limit):
+    """Snapshot tracemalloc and return the top `limit` per-line statistics, leaving out
+    the sampler's own collapsed-stack strings. Runs in a worker thread."""
+    code = sample_stacks.__code__
+    sampler_lines = {line for _, _, line in code.co_lines() if line is not None}
+    stats = []
+    for stat in tracemalloc.take_snapshot().statistics('lineno'):
+        frame = stat.traceback[0]
+        if frame.filename == code.co_filename and frame.lineno in sampler_lines: continue
+        stats.append(stat)
+        if len(stats) == limit: break
+    return stats
+
+def count_tasks_by_coroutine(loop):
+    counts = Counter()
+    for task in asyncio.all_tasks(loop):
+        coro = task.get_coro()
+        counts[getattr(coro, '__qualname__', repr(coro))] += 1
+    return counts
+
+async def count_worker_tasks():
+    return count_tasks_by_coroutine(asyncio.get_running_loop())
+
+def loop_lag_lines():
+    lines = [MAIN_LOOP_LAG.summary()]
+    if background_worker and background_worker.is_running():
+        lines.append(background_worker.lag.summary())
+    else:
+        lines.append("background: not running")
+    return lines
+
+async def lag_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update): return
+    await update.message.reply_text("⏱️ تأخير حلقات الأحداث:\n" + "\n".join(loop_lag_lines()))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update): return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+        if not (1 <= seconds <= PROFILE_MAX_SECONDS): raise ValueError()
+    except ValueError:
+        await update.message.reply_text(f"الاستخدام: /profile [1-{PROFILE_MAX_SECONDS}]")
+        return
+    if profile_lock.locked():
+        await update.message.reply_text("⏳ هناك عملية تحليل أداء قيد التشغيل بالفعل.")
+        return
+
+    async with profile_lock:
+        await update.message.reply_text(f"⏳ جارٍ تحليل أداء البوت لمدة {seconds} ثانية...")
+        # tracemalloc is only switched on for the duration of the profile.
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing: tracemalloc.start()
+        try:
+            samples = await asyncio.to_thread(sample_stacks, seconds)
+            allocations = await asyncio.to_thread(top_allocations, PROFILE_TOP_ENTRIES)
+        finally:
+            if started_tracing: tracemalloc.stop()
+        tasks = count_tasks_by_coroutine(asyncio.get_running_loop())
+        worker_tasks = Counter()
+        if background_worker and background_worker.is_running():
+            worker_tasks = await background_worker.run_coroutine(count_worker_tasks())
+
+    total_samples = sum(samples.values())
+    lines = [f"Profile {datetime.now(ZoneInfo('UTC')).isoformat()} | {BOT_VERSION}",
+             f"duration={seconds}s interval={PROFILE_SAMPLE_INTERVAL}s samples={total_samples}", "",
+             f"== Top {PROFILE_TOP_ENTRIES} stacks (collapsed) =="]
+    for stack, count in samples.most_common(PROFILE_TOP_ENTRIES):
+        lines.append(f"{count} {stack}")
+    lines += ["", f"== Top {PROFILE_TOP_ENTRIES} allocations (since profile start) =="]
+    for stat in allocations:
+        lines.append(str(stat))
+    lines += ["", "== Event loop lag =="] + loop_lag_lines()
+    lines += ["", f"== asyncio tasks, main loop ({sum(tasks.values())}) =="]
+    for name, count in tasks.most_common():
+        lines.append(f"{count} {name}")
+    lines += ["", f"== asyncio tasks, background loop ({sum(worker_tasks.values())}) =="]
+    for name, count in worker_tasks.most_common():
+        lines.append(f"{count} {name}")
+
+    report = io.BytesIO("\n".join(lines).encode('utf-8'))
+    filename = f"profile-{datetime.now(ZoneInfo('UTC')).strftime('%Y%m%d-%H%M%S')}.txt"
+    await update.message.reply_document(document=report, filename=filename, caption=f"📈 تحليل الأداء ({seconds} ثانية)")
+
+# --- Ledger Commands ---
+async def sell_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    try:
+        coin_id = int(context.args[0]); quantity = Decimal(context.args[1]); price = Decimal(context.args[2])
+        if quantity <= 0 or price <= 0: raise ValueError()
+    except (IndexError, ValueError, ArithmeticError):
+        await update.message.reply_text("الاستخدام: `/sell ID الكمية السعر`", parse_mode=ParseMode.MARKDOWN, reply_markup=MAIN_REPLY_MARKUP)
+        return
+    try:
+        realized_pnl = db_record_sell(coin_id, user_id, quantity, price)
+    except ValueError:
+        await update.message.reply_text("❌ الكمية المباعة أكبر من الكمية المملوكة.", reply_markup=MAIN_REPLY_MARKUP)
+        return
+    if realized_pnl is None:
+        await update.message.reply_text(f"لم يتم العثور على عملة بالرقم `{coin_id}`.", parse_mode=ParseMode.MARKDOWN, reply_markup=MAIN_REPLY_MARKUP)
+        return
+    pnl_icon = "📈" if realized_pnl >= 0 else "📉"
+    await update.message.reply_text(f"✅ تم تسجيل البيع.\n{pnl_icon} الربح/الخسارة المحقق: `{format_price(realized_pnl)}`",
+                                    parse_mode=ParseMode.MARKDOWN, reply_markup=MAIN_REPLY_MARKUP)
+
+async def rebuild_positions_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update): return
+    try:
+        user_id = int(context.args[0]) if context.args else update.effective_user.id
+    except ValueError:
+        await update.message.reply_text("الاستخدام: /rebuild [user_id]")
+        return
+    positions = await asyncio.to_thread(db_rebuild_positions, user_id)
+    await update.message.reply_text(f"✅ تمت إعادة بناء {positions} مركز للمستخدم {user_id} من سجل المعاملات.")
 
 # --- Add Coin Conversation ---
 async def add_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int: